@@ -7,83 +7,115 @@
 # (see https://github.com/repodiac, also for information how to provide attribution to this work)
 #
 
-import xml.etree.ElementTree as XML
+from lxml import etree as XML
 import re
 import sys
 import os
+import functools
+from collections import namedtuple
 from ipapy.kirshenbaummapper import KirshenbaumMapper
 
 # constants
 NS = {'wiktionary': 'http://www.mediawiki.org/xml/export-0.10/'}
-REGEX_SECTION_LABEL_PRONOUNCIATION = re.compile('\\{\\{Aussprache\\}\\}')
-REGEX_SECTION_LABEL_CATEGORY_LOAN_WORD = re.compile('\\[\\[Kategorie\\:Entlehnung aus dem (.+) \\(Deutsch\\)\\]\\]')
-ATTRIBUTE_IPA = ':{{IPA}} {{Lautschrift|'
+# sections of interest on a page, i.e. category of the loan word, pronounciation section and IPA attribute,
+# are matched by a single regex so that the full text is scanned only once
+REGEX_PAGE_SECTIONS = re.compile('\\[\\[Kategorie:Entlehnung aus dem (?P<category>[^\\]\\n]+?) \\(Deutsch\\)\\]\\]'
+                                 '|(?P<pronounciation>\\{\\{Aussprache\\}\\})'
+                                 '|:\\{\\{IPA\\}\\} \\{\\{Lautschrift\\|(?P<ipa>[^}]*)\\}\\}')
+CATEGORY_LOAN_WORD = '[[Kategorie:Entlehnung aus dem '
+TAG_PAGE = '{' + NS['wiktionary'] + '}page'
+# mapper is stateless for conversions, hence created only once and reused for all terms
+KIRSHENBAUM_MAPPER = KirshenbaumMapper()
+# number of terms converted to espeak-ng encodings at once (in parallel)
+CONVERSION_BATCH_SIZE = 4096
+# buffer size for writing output files
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# loan word extracted from Wiktionary
+Term = namedtuple('Term', ['label', 'category_loan_word', 'IPA'])
 
 # since full text is parsed, this global list of "has been processed already" of labels is used to prevent duplicates
 idx_list = set()
 
-def extract_loan_words(wiktionary_xml_file):
+def extract_loan_words(wiktionary_xml_file, issue_terms):
     """
     Given a valid XML file from Wiktionary, relevant loan words in German are extracted with their IPA code
     and word provenance (key=category_loan_word)
 
+    * loan words are yielded one by one while parsing, i.e. the full list of terms is never kept in memory
+
     :param wiktionary_xml_file: the input XML file from Wiktionary
+    :param issue_terms: list to which terms causing issues are appended as [label, IPA code, status] for logging
 
-    :return: list of dict with keys {'label, 'category_loan_word', 'IPA'} per loan word
+    :return: generator of `Term` (label, category_loan_word, IPA) per loan word
     """
 
-    # raw parse XML file
-    tree = XML.parse(wiktionary_xml_file)
-    root = tree.getroot()
+    # stream parse XML file, i.e. do not load the full Wiktionary dump into memory
+    context = XML.iterparse(wiktionary_xml_file, events=('end',), tag=TAG_PAGE, huge_tree=True)
 
-    terms = []
-    issue_terms = []
-    term = {}
     # iterate over Wiktionary (per term)
-    for c, page in enumerate(root.iter(tag='{' + NS['wiktionary'] + '}page')):
-
-        content = page.find('./wiktionary:revision/wiktionary:text', NS)
-        raw_text = content.text
-
-        # scan the full text for loan words (not only links etc.)
-        if raw_text:
-
-            category_loan_word_section_pos = REGEX_SECTION_LABEL_CATEGORY_LOAN_WORD.search(raw_text)
-            if category_loan_word_section_pos:
+    for _, page in context:
+
+        raw_text = page.findtext('./wiktionary:revision/wiktionary:text', namespaces=NS)
+        title = page.findtext('./wiktionary:title', namespaces=NS)
+        # all contents needed are extracted, free memory of this page and all pages parsed before
+        page.clear(keep_tail=False)
+        while page.getprevious() is not None:
+            del page.getparent()[0]
+
+        # scan the full text for loan words (not only links etc.), plain substring search beforehand is much cheaper
+        # than the regex and skips most of the pages not being a loan word at all
+        if raw_text and CATEGORY_LOAN_WORD in raw_text:
+
+            category_loan_word_section = None
+            pronounciation_section = False
+            ipa_code = None
+            for section in REGEX_PAGE_SECTIONS.finditer(raw_text):
+                if section.lastgroup == 'category':
+                    if category_loan_word_section is None:
+                        category_loan_word_section = section.group('category')
+                elif section.lastgroup == 'pronounciation':
+                    pronounciation_section = True
+                elif pronounciation_section and ipa_code is None:
+                    # IPA attribute is only taken from within the pronounciation section, i.e. after it has started
+                    ipa_code = section.group('ipa')
+                # stop scanning as soon as all sections of interest have been found
+                if category_loan_word_section is not None and ipa_code is not None:
+                    break
+
+            if category_loan_word_section:
 
-                title = page.find('./wiktionary:title', NS)
                 # NOTE: we have to enforce lowercase since espeak-ng can only deal with lowercase terms to be imported,
                 # otherwise we need explicit flags for first capital letters (@capital),
                 # see https://github.com/espeak-ng/espeak-ng/blob/master/docs/dictionary.md#flags!
-                label_list = title.text.lower().split(' ')
+                label = title.lower()
+                n_words = label.count(' ') + 1
 
-                category_loan_word = category_loan_word_section_pos.groups()[0][:-2].lower()
+                category_loan_word = category_loan_word_section[:-2].lower()
 
-                pronounciation_section_pos = REGEX_SECTION_LABEL_PRONOUNCIATION.search(raw_text)
-                ipa_code = ''
-                if pronounciation_section_pos:
-                    ipa_code_start = raw_text.find(ATTRIBUTE_IPA)
-                    if ipa_code_start > -1:
-                        ipa_code_start += len(ATTRIBUTE_IPA)
-                        ipa_code_end = ipa_code_start + raw_text[ipa_code_start:].find('}}')
-                        ipa_code = raw_text[ipa_code_start:ipa_code_end]
+                if ipa_code is None:
+                    ipa_code = ''
 
                 # espeak-ng allows up to 4 words as a term
-                if len(label_list) > 4:
-                    print('Multiword term detected -- Exceeds limit of 4 words, length =', len(label_list))
-                    print('   term =', ' '.join(label_list))
+                if n_words > 4:
+                    print('Multiword term detected -- Exceeds limit of 4 words, length =', n_words)
+                    print('   term =', label)
                     print('   IPA codes =', ipa_code)
                     print('-- EXCLUDING term!\n')
                     # add multiword term to list for logging
-                    issue_terms.append([' '.join(label_list), ipa_code, 'excluded'])
+                    issue_terms.append([label, ipa_code, 'excluded'])
                     # skip to next term
                     continue
 
-                ipa_code_list = ipa_code.split(' ') if ipa_code else []
-                label = ' '.join(label_list)
-                if len(label_list) > 1:
+                if label in idx_list:
+                    # skip duplicate term
+                    continue
+                idx_list.add(label)
+
+                if n_words > 1:
 
-                    if len(ipa_code_list) > 0 and len(ipa_code_list) < len(label_list):
+                    ipa_code_list = ipa_code.split(' ') if ipa_code else []
+                    if len(ipa_code_list) > 0 and len(ipa_code_list) < n_words:
                         print('Multiword term detected -- Number of single IPA codes is shorter than number of words:')
                         print('   term =', label)
                         print('   IPA codes =', ipa_code)
@@ -95,15 +127,7 @@ def extract_loan_words(wiktionary_xml_file):
                     # espeak-ng requires brackets if the term consists of more than one word
                     label = '(' + label + ')'
 
-                if label not in idx_list:
-                    idx_list.add(label)
-                    term['label'] = label
-                    term['category_loan_word'] = category_loan_word
-                    term['IPA'] = ipa_code
-                    terms.append(term)
-                    term = {}
-
-    return terms, issue_terms
+                yield Term(label, category_loan_word, ipa_code)
 
 
 def _ipa_code_corrections(ipa_code):
@@ -164,6 +188,7 @@ def _espeak_code_corrections(espeak_code):
         .replace(' ', '||') # espeak-ng requires/recommends using '||' for word break betweeen phonemes
 
 
+@functools.lru_cache(maxsize=None)
 def convert_ipa_2_espeak_phoneme(ipa_code, correct_phonemes=True):
     """
     Converts IPA codes (https://en.wikipedia.org/wiki/International_Phonetic_Alphabet)
@@ -172,6 +197,7 @@ def convert_ipa_2_espeak_phoneme(ipa_code, correct_phonemes=True):
     * uses internal correction methods for both IPA and espeak-ng codes to compensate variation in the used
       method from KirshenbaumMapper() in the ipapy package (https://github.com/pettarin/ipapy), see parameter
       `correct_phonemes`
+    * conversions are cached, i.e. identical IPA codes are converted only once
 
     :param ipa_code: plain IPA code to be converted to espeak-ng encoding
     :param correct_phonemes: if True (default), IPA codes are corrected if necessary for spurious encodings
@@ -185,7 +211,7 @@ def convert_ipa_2_espeak_phoneme(ipa_code, correct_phonemes=True):
     if correct_phonemes:
         ipa_code = _ipa_code_corrections(ipa_code)
     try:
-        km_list = KirshenbaumMapper().map_unicode_string(
+        km_list = KIRSHENBAUM_MAPPER.map_unicode_string(
             unicode_string=ipa_code,
             ignore=False,
             single_char_parsing=None,
@@ -203,6 +229,8 @@ def convert_ipa_2_espeak_phoneme(ipa_code, correct_phonemes=True):
 if __name__ == "__main__":
     # execute default usage if run as script
     import datetime
+    import itertools
+    from concurrent.futures import ProcessPoolExecutor
 
     if len(sys.argv) < 5:
         print('Help: generate_espeak-ng_import')
@@ -222,33 +250,46 @@ if __name__ == "__main__":
 
     # parse Wiktionary file
     print('EXTRACTING loan words from wiktionary file...')
-    terms, issue_terms = extract_loan_words(sys.argv[2])
+    issue_terms = []
+    terms = extract_loan_words(sys.argv[2], issue_terms)
     # write to espeak-ng import file as "de_extra"
-    with open(os.path.join(sys.argv[4], 'de_extra'), 'w', encoding='utf8') as fo:
-        fo.write('//\n// This work/these contents are derived from/based on Wiktionary contents, input file: '
-                 + os.path.basename(sys.argv[2]) + '\n// and created using code copyright 2020 by repodiac'
-                 + ' (see https://github.com/repodiac, also for information how to provide attribution to this work)'
-                 + '\n//\n// DATE OF CREATION: ' + datetime.date.today().strftime('%d.%m.%Y') + '\n//\n\n')
+    # NOTE: files are written in binary mode with a large buffer, each line is encoded (UTF-8) at once
+    with open(os.path.join(sys.argv[4], 'de_extra'), 'wb', buffering=OUTPUT_BUFFER_SIZE) as fo:
+        fo.write(('//\n// This work/these contents are derived from/based on Wiktionary contents, input file: '
+                  + os.path.basename(sys.argv[2]) + '\n// and created using code copyright 2020 by repodiac'
+                  + ' (see https://github.com/repodiac, also for information how to provide attribution to this work)'
+                  + '\n//\n// DATE OF CREATION: ' + datetime.date.today().strftime('%d.%m.%Y') + '\n//\n\n')
+                 .encode('utf8'))
 
         print('CONVERTING IPA codes to espeak-ng encodings...')
-        for t in terms:
-            # convert IPA codes from Wiktionary to espeak-ng compatible encodings
-            converted_espeak = convert_ipa_2_espeak_phoneme(t['IPA'])
-            if not converted_espeak:
-                issue_terms.append([t['label'], 'not available', 'excluded'])
-            elif converted_espeak == 'failed':
-                issue_terms.append([t['label'], t['IPA'], 'excluded'])
-            else:
-                t['ESPEAK'] = _espeak_code_corrections(converted_espeak)
-                fo.write('\t'.join([t['label'], t['ESPEAK']]) + '\n')
+        # convert IPA codes from Wiktionary to espeak-ng compatible encodings, in parallel since terms are independent
+        # NOTE: terms are converted in batches, since `executor.map` consumes its whole input at once -- this keeps
+        # streaming terms from parsing to the output file, instead of collecting all terms of the dump beforehand.
+        # One batch is always in flight, i.e. the worker processes convert a batch while the next one is parsed
+        with ProcessPoolExecutor() as executor:
+            batch, converted_espeak_codes = [], []
+            while True:
+                next_batch = list(itertools.islice(terms, CONVERSION_BATCH_SIZE))
+                next_converted_espeak_codes = executor.map(convert_ipa_2_espeak_phoneme,
+                                                           [t.IPA for t in next_batch], chunksize=256)
+                for t, converted_espeak in zip(batch, converted_espeak_codes):
+                    if not converted_espeak:
+                        issue_terms.append([t.label, 'not available', 'excluded'])
+                    elif converted_espeak == 'failed':
+                        issue_terms.append([t.label, t.IPA, 'excluded'])
+                    else:
+                        fo.write((t.label + '\t' + converted_espeak + '\n').encode('utf8'))
+                if not next_batch:
+                    break
+                batch, converted_espeak_codes = next_batch, next_converted_espeak_codes
 
     # write log file for terms with issues, either INCLUDED (multiword terms) or
     # EXCLUDED from the output (failing IPA codes)
     if issue_terms:
-        with open(os.path.join(sys.argv[4], 'issue_terms.tab'), 'w', encoding='utf8') as ito:
-            ito.write('\t'.join(['loan_word', 'IPA_code','status']) + '\n')
+        with open(os.path.join(sys.argv[4], 'issue_terms.tab'), 'wb', buffering=OUTPUT_BUFFER_SIZE) as ito:
+            ito.write(('\t'.join(['loan_word', 'IPA_code','status']) + '\n').encode('utf8'))
             for it in issue_terms:
-                ito.write('\t'.join(it) + '\n')
+                ito.write(('\t'.join(it) + '\n').encode('utf8'))
 
         print()
         print('**** PLEASE NOTE ****')